@@ -1,18 +1,29 @@
 """
 Admin settings for the dhcpkit looking glass
 """
+import re
 
 from dhcpkit_looking_glass.filters import MultipleDUIDFilter, DuplicateDUIDFilter, ResponseFilter
 from dhcpkit_looking_glass.models import Client, Server, Transaction
+from dhcpkit_looking_glass.utils import EstimatedCountPaginator
 from django.contrib import admin
 from django.core.urlresolvers import reverse
-from django.db.models.aggregates import Count
 from django.db.models.query import QuerySet
+from django.db.models.query_utils import Q
 from django.http.request import HttpRequest
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _, ungettext
 
+# Timestamp format for the changelist columns, parsed once instead of per row
+TS_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Search terms that are unmistakably a DUID ('0x' plus hex) or a MAC address (two-digit hex
+# groups with separators). Deliberately narrow: IPv6 addresses and plain numbers must keep
+# taking the full search path so they can be found inside the packet contents.
+MAC_SEARCH_RE = re.compile(r'^0x[0-9a-f]+$|^[0-9a-f]{2}([:.-][0-9a-f]{2})+$', re.IGNORECASE)
+
 
 @admin.register(Server)
 class ServerAdmin(admin.ModelAdmin):
@@ -31,6 +42,8 @@ class ClientAdmin(admin.ModelAdmin):
     list_display = ('admin_duid', 'interface_id', 'remote_id', 'admin_transactions_link')
     list_filter = (MultipleDUIDFilter, DuplicateDUIDFilter)
     search_fields = ('interface_id', 'remote_id')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     readonly_fields = ('duid', 'duid_ll', 'duid_ll_org', 'interface_id', 'remote_id')
     fieldsets = (
@@ -41,17 +54,15 @@ class ClientAdmin(admin.ModelAdmin):
         }),
     )
 
-    def get_queryset(self, request: HttpRequest) -> QuerySet:
+    @cached_property
+    def transaction_changelist_url(self) -> str:
         """
-        Get the transaction counts in one go
+        Resolve the URL of the transaction changelist once instead of for every row
 
-        :param request: The incoming request
-        :return: The queryset with clients
+        :return: The URL of the transaction changelist
         """
-        qs = super().get_queryset(request)
-        return qs.annotate(num_transactions=Count('transaction'))
+        return reverse("admin:dhcpkit_looking_glass_transaction_changelist")
 
-    # noinspection PyMethodMayBeStatic
     def admin_transactions_link(self, client: Client) -> str:
         """
         Show a link to the transactions for this client
@@ -61,13 +72,14 @@ class ClientAdmin(admin.ModelAdmin):
         """
         return format_html('<a href="{url}?client={client_id}">{label}</a>',
                            client_id=client.id,
-                           url=reverse("admin:dhcpkit_looking_glass_transaction_changelist"),
+                           url=self.transaction_changelist_url,
                            label=ungettext(
                                "{count} transaction",
                                "{count} transactions",
                                client.num_transactions).format(count=client.num_transactions))
 
     admin_transactions_link.short_description = _("Transactions")
+    admin_transactions_link.admin_order_field = 'num_transactions'
 
     # noinspection PyMethodMayBeStatic
     def admin_duid(self, client: Client) -> str:
@@ -93,7 +105,10 @@ class TransactionAdmin(admin.ModelAdmin):
     list_display = ('admin_duid', 'admin_interface_id', 'admin_remote_id',
                     'server', 'admin_request_ts_ms',
                     'request_ll', 'request_type', 'response_type')
+    list_select_related = ('client', 'server')
     search_fields = ('client__duid', 'client__interface_id', 'client__remote_id', 'request', 'response')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     readonly_fields = ('client_duid', 'client_duid_ll', 'client_duid_ll_org',
                        'request_ll', 'request_ll_mac', 'request_ll_mac_org',
@@ -116,7 +131,37 @@ class TransactionAdmin(admin.ModelAdmin):
         }),
     )
 
-    # noinspection PyMethodMayBeStatic
+    def get_queryset(self, request: HttpRequest) -> QuerySet:
+        """
+        Fetch the related client and server in the same query, and leave the large packet blobs
+        in the database: the changelist never shows them and the change view re-fetches them
+
+        :param request: The incoming request
+        :return: The queryset with transactions
+        """
+        # Resolve the active timezone once instead of for every timestamp column
+        self._list_timezone = timezone.get_current_timezone()
+        qs = super().get_queryset(request)
+        return qs.select_related('client', 'server').defer('request', 'response')
+
+    def get_search_results(self, request: HttpRequest, queryset: QuerySet, search_term: str):
+        """
+        Only search the small indexed client columns when the term looks like a MAC address or
+        DUID, so the common operator lookups don't trigger LIKE scans over the packet blobs
+
+        :param request: The incoming request
+        :param queryset: The queryset to search in
+        :param search_term: The term the admin searched for
+        :return: The filtered queryset and whether distinct() may be needed
+        """
+        if search_term and MAC_SEARCH_RE.match(search_term):
+            queryset = queryset.filter(Q(client__duid__icontains=search_term) |
+                                       Q(client__interface_id__icontains=search_term) |
+                                       Q(client__remote_id__icontains=search_term))
+            return queryset, False
+
+        return super().get_search_results(request, queryset, search_term)
+
     def admin_request_ts_ms(self, transaction: Transaction) -> str:
         """
         Show the last request timestamp with milliseconds
@@ -124,12 +169,12 @@ class TransactionAdmin(admin.ModelAdmin):
         :param transaction: The transaction
         :return: The timestamp as a string
         """
-        return "{:%Y-%m-%d %H:%M:%S.%f}".format(timezone.localtime(transaction.request_ts))
+        tz = getattr(self, '_list_timezone', None) or timezone.get_current_timezone()
+        return transaction.request_ts.astimezone(tz).strftime(TS_FORMAT)
 
     admin_request_ts_ms.short_description = _('last request')
     admin_request_ts_ms.admin_order_field = 'request_ts'
 
-    # noinspection PyMethodMayBeStatic
     def admin_response_ts_ms(self, transaction: Transaction) -> str:
         """
         Show the last response timestamp with milliseconds
@@ -137,9 +182,13 @@ class TransactionAdmin(admin.ModelAdmin):
         :param transaction: The transaction
         :return: The timestamp as a string
         """
-        return "{:%Y-%m-%d %H:%M:%S.%f}".format(timezone.localtime(transaction.response_ts))
+        if transaction.response_ts is None:
+            return ''
+
+        tz = getattr(self, '_list_timezone', None) or timezone.get_current_timezone()
+        return transaction.response_ts.astimezone(tz).strftime(TS_FORMAT)
 
-    admin_response_ts_ms.short_description = _('last request')
+    admin_response_ts_ms.short_description = _('last response')
     admin_response_ts_ms.admin_order_field = 'response_ts'
 
     # noinspection PyMethodMayBeStatic
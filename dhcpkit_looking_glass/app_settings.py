@@ -15,3 +15,8 @@ if MAX_TRANSACTIONS and not isinstance(MAX_TRANSACTIONS, int):
 MAX_TRANSACTION_AGE = getattr(settings, 'DHCPKIT_LG_MAX_TRANSACTION_AGE', datetime.timedelta(days=7))
 if MAX_TRANSACTION_AGE and not isinstance(MAX_TRANSACTION_AGE, datetime.timedelta):
     raise ImproperlyConfigured("DHCPKIT_LG_MAX_TRANSACTIONS must be None or a timedelta")
+
+# How long to cache the expensive duplicate-DUID filter lookups, in seconds
+FILTER_CACHE_TIMEOUT = getattr(settings, 'DHCPKIT_LG_FILTER_CACHE_TIMEOUT', 300)
+if not isinstance(FILTER_CACHE_TIMEOUT, int):
+    raise ImproperlyConfigured("DHCPKIT_LG_FILTER_CACHE_TIMEOUT must be an integer")
@@ -5,16 +5,119 @@ from datetime import timedelta
 
 from django.contrib import admin
 from django.contrib.admin.filters import SimpleListFilter
+from django.core.cache import cache
 from django.db.models.aggregates import Count
 from django.db.models.expressions import F, Value
 from django.db.models.functions import Concat
 from django.db.models.query import QuerySet
+from django.db.models.query_utils import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http.request import HttpRequest
 from django.utils.translation import ugettext_lazy as _
-from typing import Tuple, Iterable
+from typing import Iterable, Optional, Tuple
 
+from dhcpkit_looking_glass import app_settings
 from dhcpkit_looking_glass.models import Client
 
+# Filter conditions for ResponseFilter, built once instead of per request
+ONE_SECOND = timedelta(seconds=1)
+SLOW_RESPONSE_Q = Q(response_ts__gt=F('request_ts') + ONE_SECOND)
+NO_RESPONSE_Q = Q(response='')
+
+# The lookup tuples of the filters below, built once instead of per request
+RESPONSE_LOOKUPS = (('slow', _('Slow responses (>1s)')),
+                    ('no', _('No response')))
+MULTIPLE_DUID_LOOKUPS = (('per_interface_id', _('per Interface-ID')),
+                         ('per_remote_id', _('per Remote-ID')),
+                         ('per_combined', _('per combination of both')))
+DUPLICATE_DUID_LOOKUPS = (('yes', _('DUID on different ports')),
+                          )
+
+# Inlining cached values into the query only works for modest set sizes: SQLite limits
+# both the number of bind parameters and the expression depth to roughly a thousand.
+# Larger sets fall back to a subquery.
+MAX_FILTER_VALUES = 500
+
+# Cached marker for "more than MAX_FILTER_VALUES matches, use a subquery"
+TOO_MANY_VALUES = 'too many'
+
+
+def _cache_key(group_fields: Tuple[str, ...], count_fields: Tuple[str, ...]) -> str:
+    """
+    Build the cache key for a duplicate-clients lookup
+
+    :param group_fields: The fields the clients are grouped by
+    :param count_fields: The fields that are counted per group
+    :return: The cache key
+    """
+    return 'dhcpkit_lg:duplicate_clients:{}:{}'.format(','.join(group_fields), ','.join(count_fields))
+
+
+# The lookups used by the filters below, so the signal handler knows which keys to invalidate
+FILTER_CACHE_KEYS = (_cache_key(('interface_id',), ('duid',)),
+                     _cache_key(('remote_id',), ('duid',)),
+                     _cache_key(('interface_id', 'remote_id'), ('duid',)),
+                     _cache_key(('duid',), ('interface_id', 'remote_id')))
+
+
+def duplicate_clients(group_fields: Tuple[str, ...],
+                      count_fields: Tuple[str, ...] = ('duid',)) -> QuerySet:
+    """
+    Build the queryset with the values of group_fields for which the clients table contains
+    more than one count_fields entry.
+
+    :param group_fields: The fields to group the clients by
+    :param count_fields: The fields to count per group
+    :return: The queryset with matching group_fields values
+    """
+    return Client.objects.values(*group_fields) \
+        .annotate(dupe_count=Count(*count_fields)) \
+        .filter(dupe_count__gt=1)
+
+
+def duplicate_client_values(group_fields: Tuple[str, ...],
+                            count_fields: Tuple[str, ...] = ('duid',)) -> Optional[list]:
+    """
+    Get the values of group_fields for which the clients table contains more than one
+    count_fields entry. The result is cached because all filters below share this query shape
+    and it groups over the whole clients table.
+
+    :param group_fields: The fields to group the clients by
+    :param count_fields: The fields to count per group
+    :return: A list of values (or tuples of values when grouping by multiple fields), or None
+             when there are too many values to inline into a query
+    """
+    # Every value binds one parameter per group field, so multi-field sets get a
+    # proportionally lower cap to stay under the limit
+    max_values = MAX_FILTER_VALUES // len(group_fields)
+
+    key = _cache_key(group_fields, count_fields)
+    values = cache.get(key)
+    if values is None:
+        values = list(duplicate_clients(group_fields, count_fields)
+                      .values_list(*group_fields, flat=len(group_fields) == 1)
+                      [:max_values + 1])
+        if len(values) > max_values:
+            values = TOO_MANY_VALUES
+        cache.set(key, values, app_settings.FILTER_CACHE_TIMEOUT)
+
+    if values == TOO_MANY_VALUES:
+        return None
+    return values
+
+
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=Client, dispatch_uid='dhcpkit_lg_clear_filter_cache')
+@receiver(post_delete, sender=Client, dispatch_uid='dhcpkit_lg_clear_filter_cache')
+def clear_filter_cache(sender, **kwargs):
+    """
+    Throw away the cached filter values whenever a client changes
+
+    :param sender: The Client model
+    """
+    cache.delete_many(FILTER_CACHE_KEYS)
+
 
 class ResponseFilter(SimpleListFilter):
     """
@@ -31,8 +134,7 @@ class ResponseFilter(SimpleListFilter):
         :param model_admin:
         :return: A list of lookups
         """
-        return (('slow', _('Slow responses (>1s)')),
-                ('no', _('No response')))
+        return RESPONSE_LOOKUPS
 
     def queryset(self, request: HttpRequest, queryset: QuerySet) -> QuerySet:
         """
@@ -44,9 +146,9 @@ class ResponseFilter(SimpleListFilter):
         """
         val = self.value()
         if val == 'slow':
-            return queryset.filter(response_ts__gt=F('request_ts') + timedelta(seconds=1))
+            return queryset.filter(SLOW_RESPONSE_Q)
         elif val == 'no':
-            return queryset.filter(response='')
+            return queryset.filter(NO_RESPONSE_Q)
         else:
             return queryset
 
@@ -66,9 +168,7 @@ class MultipleDUIDFilter(SimpleListFilter):
         :param model_admin:
         :return: A list of lookups
         """
-        return (('per_interface_id', _('per Interface-ID')),
-                ('per_remote_id', _('per Remote-ID')),
-                ('per_combined', _('per combination of both')))
+        return MULTIPLE_DUID_LOOKUPS
 
     def queryset(self, request: HttpRequest, queryset: QuerySet) -> QuerySet:
         """
@@ -80,25 +180,35 @@ class MultipleDUIDFilter(SimpleListFilter):
         """
         val = self.value()
         if val == 'per_interface_id':
-            return queryset \
-                .filter(interface_id__in=Client.objects.values('interface_id')
-                        .annotate(duid_count=Count('duid'))
-                        .filter(duid_count__gt=1)
-                        .values('interface_id'))
+            values = duplicate_client_values(('interface_id',))
+            if values is None:
+                return queryset.filter(interface_id__in=duplicate_clients(('interface_id',))
+                                       .values('interface_id'))
+            return queryset.filter(interface_id__in=values)
         elif val == 'per_remote_id':
-            return queryset \
-                .filter(remote_id__in=Client.objects.values('remote_id')
-                        .annotate(duid_count=Count('duid'))
-                        .filter(duid_count__gt=1)
-                        .values('remote_id'))
+            values = duplicate_client_values(('remote_id',))
+            if values is None:
+                return queryset.filter(remote_id__in=duplicate_clients(('remote_id',))
+                                       .values('remote_id'))
+            return queryset.filter(remote_id__in=values)
         elif val == 'per_combined':
-            return queryset \
-                .annotate(concat_id=Concat('remote_id', Value('|'), 'interface_id')) \
-                .filter(concat_id__in=Client.objects.values('interface_id', 'remote_id')
-                        .annotate(duid_count=Count('duid'))
-                        .filter(duid_count__gt=1)
-                        .annotate(concat_id=Concat('remote_id', Value('|'), 'interface_id'))
-                        .values('concat_id'))
+            combinations = duplicate_client_values(('interface_id', 'remote_id'))
+            if combinations is None:
+                # Too many pairs to inline as OR terms without hitting the backend's
+                # expression-depth limit: join on a concatenated key instead
+                return queryset \
+                    .annotate(concat_id=Concat('remote_id', Value('|'), 'interface_id')) \
+                    .filter(concat_id__in=duplicate_clients(('interface_id', 'remote_id'))
+                            .annotate(concat_id=Concat('remote_id', Value('|'), 'interface_id'))
+                            .values('concat_id'))
+
+            if not combinations:
+                return queryset.none()
+
+            condition = Q()
+            for interface_id, remote_id in combinations:
+                condition |= Q(interface_id=interface_id, remote_id=remote_id)
+            return queryset.filter(condition)
         else:
             return queryset
 
@@ -118,8 +228,7 @@ class DuplicateDUIDFilter(SimpleListFilter):
         :param model_admin:
         :return: A list of lookups
         """
-        return (('yes', _('DUID on different ports')),
-                )
+        return DUPLICATE_DUID_LOOKUPS
 
     def queryset(self, request: HttpRequest, queryset: QuerySet) -> QuerySet:
         """
@@ -131,10 +240,11 @@ class DuplicateDUIDFilter(SimpleListFilter):
         """
         val = self.value()
         if val == 'yes':
-            return queryset \
-                .filter(duid__in=Client.objects.values('duid')
-                        .annotate(port_count=Count('interface_id', 'remote_id'))
-                        .filter(port_count__gt=1)
-                        .values('duid'))
+            duids = duplicate_client_values(('duid',), ('interface_id', 'remote_id'))
+            if duids is None:
+                return queryset.filter(duid__in=duplicate_clients(('duid',),
+                                                                  ('interface_id', 'remote_id'))
+                                       .values('duid'))
+            return queryset.filter(duid__in=duids)
         else:
             return queryset
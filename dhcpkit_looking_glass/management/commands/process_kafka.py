@@ -1,18 +1,17 @@
 """
 Process to read Kafka messages and save a summary to the database
 """
-import codecs
 import datetime
-import json
 import logging
+import multiprocessing
 import re
 import signal
 import socket
 import time
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import Counter, OrderedDict
 
 import pykafka
-import pytz
 from dhcpkit.common.server.logging.verbosity import set_verbosity_logger
 from dhcpkit.ipv6.extensions.remote_id import RemoteIdOption
 from dhcpkit.ipv6.messages import RelayReplyMessage, ClientServerMessage
@@ -22,13 +21,44 @@ from dhcpkit.protocol_element import JSONProtocolElementEncoder
 from dhcpkit_kafka.messages import KafkaMessage, DHCPKafkaMessage
 from dhcpkit_looking_glass import app_settings
 from dhcpkit_looking_glass.models import Client, Server, Transaction
+from dhcpkit_looking_glass.utils import mac_from_duid
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models.aggregates import Count
+from django.db.models.expressions import F
+from django.db.transaction import atomic
+from django.utils import timezone
 from pykafka.common import OffsetType
 from pykafka.exceptions import ConsumerStoppedException
-from typing import Dict
+from typing import Dict, List, Optional
+
+try:
+    # orjson is a C implementation that serialises several times faster than the stdlib
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger()
 
+# How many Kafka messages to process as one batch before flushing to the database
+BATCH_SIZE = 500
+
+# How many seconds a partial batch may wait before it is flushed anyway
+FLUSH_INTERVAL = 1.0
+
+# How many values to put in an __in lookup at once: SQLite only allows about a thousand
+# bind parameters per query
+QUERY_CHUNK_SIZE = 300
+
+# How many client ids to keep in the in-process cache
+CLIENT_CACHE_SIZE = 100000
+
+# How many seconds to wait between pruning runs
+PRUNE_INTERVAL = 30
+
+# Matches the port number at the end of a broker address
+_BROKER_PORT_RE = re.compile(r':\d+$')
+
 
 def _format_host_port(host: str, port: int) -> str:
     """
@@ -58,12 +88,52 @@ def _fix_broker(broker: str) -> str:
     :param broker: Raw broker name
     :return: Fixed broker name
     """
-    if not re.match(':\d+$', broker):
+    if not _BROKER_PORT_RE.search(broker):
         broker += ':9092'
 
     return broker
 
 
+# Cache of message class to displayed type name: the set of message classes is small and
+# fixed, and this lookup happens for every processed packet
+message_type_names = {}
+
+
+def _message_type_name(cls: type) -> str:
+    """
+    Get the display name of a message type, without the redundant 'Message' suffix
+
+    :param cls: The message class
+    :return: The type name
+    """
+    try:
+        return message_type_names[cls]
+    except KeyError:
+        name = cls.__name__
+        if name.endswith('Message'):
+            name = name[:-7]
+        message_type_names[cls] = name
+        return name
+
+
+# The stdlib fallback path reuses one encoder instance, and orjson borrows its default()
+# hook so both paths produce identical JSON
+_json_encoder = JSONProtocolElementEncoder()
+
+
+def _dump_message(message) -> str:
+    """
+    Serialise a DHCP message to JSON for storage
+
+    :param message: The protocol element to serialise
+    :return: The JSON string
+    """
+    if orjson is not None:
+        return orjson.dumps(message, default=_json_encoder.default).decode('utf-8')
+
+    return _json_encoder.encode(message)
+
+
 stopping = False
 
 
@@ -101,6 +171,8 @@ class Command(BaseCommand):
                             help='Start processing messages from the beginning instead of continuing')
         parser.add_argument('--skip-backlog', action='store_true',
                             help='Ignore old messages instead of continuing where we left off')
+        parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='The number of worker processes to join the consumer group with')
 
         parser.formatter_class = ArgumentDefaultsHelpFormatter
 
@@ -117,6 +189,41 @@ class Command(BaseCommand):
         signal.signal(signal.SIGINT, signal_stop)
         signal.signal(signal.SIGTERM, signal_stop)
 
+        if options['workers'] > 1:
+            # Kafka distributes the topic partitions over all consumers in the group, so
+            # running extra worker processes scales processing across cores without any
+            # coordination on our side. Close the inherited database connections first so
+            # every worker opens its own after the fork.
+            connections.close_all()
+
+            workers = []
+            for worker_nr in range(options['workers']):
+                worker = multiprocessing.Process(target=self.consume_loop, args=(options,),
+                                                 name='worker-{}'.format(worker_nr))
+                worker.start()
+                workers.append(worker)
+
+            for worker in workers:
+                worker.join()
+        else:
+            self.consume_loop(options)
+
+    def consume_loop(self, options):
+        """
+        Consume and process Kafka messages until we are told to stop
+
+        :param options: The command line options
+        """
+        # In-process caches of primary keys so repeat clients and servers don't cost two
+        # queries per message. There are only a handful of servers, so load them all upfront;
+        # the client cache is size-limited and evicts its least recently used entry.
+        self._server_cache = dict(Server.objects.values_list('name', 'id'))
+        self._client_cache = OrderedDict()
+
+        # The client/server pairs that received transactions since the last pruning run
+        self._dirty_pairs = set()
+        self._last_prune = time.monotonic()
+
         while not stopping:
             try:
                 # noinspection PyTypeChecker
@@ -127,24 +234,48 @@ class Command(BaseCommand):
 
                 kafka_consumer = kafka_topic.get_balanced_consumer(
                     consumer_group=options['consumer_group'].encode('ascii'),
-                    auto_commit_enable=True,
+                    auto_commit_enable=False,
                     auto_offset_reset=OffsetType.LATEST if options['skip_backlog'] else OffsetType.EARLIEST,
                     reset_offset_on_start=options['from_beginning'] or options['skip_backlog'],
-                    consumer_timeout_ms=1000
+                    consumer_timeout_ms=1000,
+
+                    # DHCP messages are small and frequent: let the broker accumulate up to
+                    # 64KB (or 200ms) per fetch and prefetch ahead of processing instead of
+                    # doing a round-trip per message
+                    fetch_min_bytes=64 * 1024,
+                    fetch_wait_max_ms=200,
+                    queued_max_messages=10000,
+                    num_consumer_fetchers=2
                 )
 
                 while not stopping:
+                    batch = []
+                    last_flush = time.monotonic()
                     for incoming_message in kafka_consumer:
                         try:
                             length, message = KafkaMessage.parse(incoming_message.value)
-                            if not isinstance(message, DHCPKafkaMessage):
-                                # We aren't interested in this message
-                                continue
-
-                            self.process_message(message)
+                            if isinstance(message, DHCPKafkaMessage):
+                                batch.append(message)
                         except Exception as e:
                             logger.error("Received invalid message from Kafka: {}".format(e))
 
+                        # Flush on size, but also on time so a slow trickle of messages
+                        # still becomes visible (and has its offsets committed) promptly
+                        if len(batch) >= BATCH_SIZE \
+                                or (batch and time.monotonic() - last_flush >= FLUSH_INTERVAL):
+                            self.process_batch(batch)
+                            kafka_consumer.commit_offsets()
+                            batch = []
+                            last_flush = time.monotonic()
+
+                        if stopping:
+                            break
+
+                    # The consumer timed out without new messages: flush what we have
+                    if batch:
+                        self.process_batch(batch)
+                        kafka_consumer.commit_offsets()
+
             except ConsumerStoppedException:
                 return
 
@@ -153,49 +284,211 @@ class Command(BaseCommand):
                 time.sleep(5)
                 logger.info("Restarting")
 
+    def process_batch(self, batch: List[DHCPKafkaMessage]):
+        """
+        Process a batch of Kafka DHCP messages, writing all transactions with as few queries
+        as possible
+
+        :param batch: The parsed messages
+        """
+        # Build one row per (client, server, request_ts) key, the newest data winning when a
+        # batch contains retransmissions of the same transaction
+        rows = {}
+        for message in batch:
+            try:
+                row = self.build_transaction(message)
+                if row is not None:
+                    rows[(row.client_id, row.server_id, row.request_ts)] = row
+            except Exception as e:
+                logger.error("Error while processing message from Kafka: {}".format(e))
+
+        if not rows:
+            return
+
+        try:
+            with atomic():
+                self.store_transactions(rows)
+        except Exception as e:
+            logger.error("Bulk insert failed ({}), falling back to row-by-row storage".format(e))
+            for row in rows.values():
+                try:
+                    self.store_transaction(row)
+                except Exception as e:
+                    logger.error("Error while storing transaction: {}".format(e))
+
+        # Only keep the last transactions per client/server. Pruning is amortized: remember
+        # which pairs were touched and clean them up periodically instead of per batch.
+        self._dirty_pairs.update((row.client_id, row.server_id) for row in rows.values())
+        self.prune_transactions()
+
     @staticmethod
-    def get_transaction_info(message: DHCPKafkaMessage) -> Dict[str, object]:
+    def store_transactions(rows: Dict[tuple, Transaction]):
+        """
+        Store a batch of transactions: update the ones that already exist and insert the rest
+        with one bulk query
+
+        :param rows: The unsaved transactions, keyed on (client_id, server_id, request_ts)
+        """
+        # Find the transactions that already exist. The filter is a superset of the batch keys,
+        # the exact match happens on the tuples below. The keys are looked up in chunks so the
+        # three __in sets together stay under the backend's bind-parameter limit.
+        existing = {}
+        keys = list(rows)
+        for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+            chunk = keys[start:start + QUERY_CHUNK_SIZE]
+            candidates = Transaction.objects.filter(
+                client_id__in={key[0] for key in chunk},
+                server_id__in={key[1] for key in chunk},
+                request_ts__in={key[2] for key in chunk},
+            ).values_list('pk', 'client_id', 'server_id', 'request_ts')
+            for pk, client_id, server_id, request_ts in candidates:
+                key = (client_id, server_id, request_ts)
+                if key in rows:
+                    existing[key] = pk
+
+        # Update existing transactions (the uncommon case: retransmissions)
+        for key, pk in existing.items():
+            row = rows[key]
+            Transaction.objects.filter(pk=pk).update(request_type=row.request_type,
+                                                     request=row.request,
+                                                     request_ll=row.request_ll,
+                                                     response_type=row.response_type,
+                                                     response_ts=row.response_ts,
+                                                     response=row.response)
+
+        # Insert all new transactions in one go. No explicit batch_size: Django derives one
+        # from the backend's bind-parameter limit, which an explicit value would override.
+        new_rows = [row for key, row in rows.items() if key not in existing]
+        Transaction.objects.bulk_create(new_rows)
+
+        # bulk_create doesn't send post_save signals, so maintain the per-client transaction
+        # counters ourselves
+        for client_id, created in Counter(row.client_id for row in new_rows).items():
+            Client.objects.filter(pk=client_id).update(num_transactions=F('num_transactions') + created)
+
+    @staticmethod
+    def store_transaction(row: Transaction):
+        """
+        Store a single transaction, used as fallback when storing a whole batch fails
+
+        :param row: The unsaved transaction
+        """
+        Transaction.objects.update_or_create(client_id=row.client_id,
+                                             server_id=row.server_id,
+                                             request_ts=row.request_ts,
+                                             defaults={
+                                                 'request_type': row.request_type,
+                                                 'request': row.request,
+                                                 'request_ll': row.request_ll,
+
+                                                 'response_type': row.response_type,
+                                                 'response_ts': row.response_ts,
+                                                 'response': row.response,
+                                             })
+
+    def _get_server_id(self, name: str) -> int:
+        """
+        Get the id of the server with the given name, creating it if it doesn't exist yet
+
+        :param name: The server name
+        :return: The server id
+        """
+        try:
+            return self._server_cache[name]
+        except KeyError:
+            server, created = Server.objects.get_or_create(name=name)
+            if created:
+                logger.info("Discovered new server: {}".format(server))
+
+            self._server_cache[name] = server.id
+            return server.id
+
+    def _get_client_id(self, duid: str, interface_id: str, remote_id: str) -> int:
+        """
+        Get the id of the client with the given identifiers, creating it if it doesn't exist yet
+
+        :param duid: The DUID of the client
+        :param interface_id: The Interface-ID of the client
+        :param remote_id: The Remote-ID of the client
+        :return: The client id
+        """
+        key = (duid, interface_id, remote_id)
+        try:
+            # Move the entry to the most-recently-used end of the cache
+            client_id = self._client_cache.pop(key)
+        except KeyError:
+            client, created = Client.objects.get_or_create(duid=duid,
+                                                           interface_id=interface_id,
+                                                           remote_id=remote_id,
+                                                           defaults={
+                                                               'duid_ll': str(mac_from_duid(duid) or '')
+                                                           })
+            if created:
+                logger.info("Discovered new client: {}".format(client))
+
+            client_id = client.id
+            if len(self._client_cache) >= CLIENT_CACHE_SIZE:
+                self._client_cache.popitem(last=False)
+
+        self._client_cache[key] = client_id
+        return client_id
+
+    @staticmethod
+    def get_transaction_info(message: DHCPKafkaMessage) -> Optional[Dict[str, object]]:
         """
         Extract interesting data from the incoming message
 
         :param message: The Kafka DHCP message
-        :return: A dictionary of stuff
+        :return: A dictionary of stuff, or None if this message can't be logged
         """
         # Split the message into usable blocks
         request, incoming_relay_messages = split_relay_chain(message.message_in)
 
+        # Without a client identifier or relay information there is nothing useful to log,
+        # so bail out before doing any expensive work
+        client_id_option = request.get_option_of_type(ClientIdOption)
+        if client_id_option is None or not incoming_relay_messages:
+            return None
+
         # Get the DUID and create representations for in the database
-        duid_obj = request.get_option_of_type(ClientIdOption).duid
-        duid = '0x' + codecs.encode(duid_obj.save(), 'hex').decode('ascii')
+        duid = '0x' + client_id_option.duid.save().hex()
 
-        # Get the link-local address of the client
-        link_local = str(incoming_relay_messages[0].peer_address)
+        relay = incoming_relay_messages[0]
 
-        # Get the Interface ID and create representation for in the database
-        interface_id_obj = incoming_relay_messages[0].get_option_of_type(InterfaceIdOption)
+        # Get the link-local address of the client
+        link_local = str(relay.peer_address)
+
+        # Find the interesting relay options in a single pass over the option list instead of
+        # scanning it once per option type
+        interface_id_obj = None
+        remote_id_obj = None
+        for option in relay.options:
+            if interface_id_obj is None and isinstance(option, InterfaceIdOption):
+                interface_id_obj = option
+            elif remote_id_obj is None and isinstance(option, RemoteIdOption):
+                remote_id_obj = option
+
+        # Create a representation of the Interface ID for in the database
         if interface_id_obj:
             try:
                 interface_id = interface_id_obj.interface_id.decode('ascii')
             except ValueError:
-                interface_id = '0x' + codecs.encode(interface_id_obj.interface_id, 'hex').decode('ascii')
+                interface_id = '0x' + interface_id_obj.interface_id.hex()
         else:
             interface_id = ''
 
-        # Get the Remote ID and create representation for in the database
-        remote_id_obj = incoming_relay_messages[0].get_option_of_type(RemoteIdOption)
+        # Create a representation of the Remote ID for in the database
         if remote_id_obj:
             try:
                 remote_id = '{}:{}'.format(remote_id_obj.enterprise_number, remote_id_obj.remote_id.decode('ascii'))
             except ValueError:
                 remote_id = '{}:0x{}'.format(remote_id_obj.enterprise_number,
-                                             codecs.encode(remote_id_obj.remote_id, 'hex').decode('ascii'))
+                                             remote_id_obj.remote_id.hex())
         else:
             remote_id = ''
 
         # Get the request type
-        request_type = request.__class__.__name__
-        if request_type.endswith('Message'):
-            request_type = request_type[:-7]
+        request_type = _message_type_name(request.__class__)
 
         # Get the response type
         response = message.message_out
@@ -216,67 +509,110 @@ class Command(BaseCommand):
             'response_type': response_type,
         }
 
-    def process_message(self, message: DHCPKafkaMessage):
+    def build_transaction(self, message: DHCPKafkaMessage) -> Optional[Transaction]:
         """
-        Process a single KafkaMessage
+        Build the unsaved Transaction for a single KafkaMessage
 
         :param message: The message
+        :return: The unsaved transaction, or None if this message can't be logged
         """
         # Do we have an incoming message?
         if not message.message_in:
-            return
+            return None
 
         # Extract transaction info
         info = self.get_transaction_info(message)
+        if info is None:
+            return None
 
         # Get the server and client
-        server, created = Server.objects.get_or_create(name=message.server_name)
-        if created:
-            logger.info("Discovered new server: {}".format(server))
-
-        client, created = Client.objects.get_or_create(duid=info['duid'],
-                                                       interface_id=info['interface_id'],
-                                                       remote_id=info['remote_id'])
-        if created:
-            logger.info("Discovered new client: {}".format(client))
-
-        # Save the response
-        logger.info("Saving DHCP transaction from {} to {}".format(client, server))
-
-        request_ts = datetime.datetime.utcfromtimestamp(message.timestamp_in).replace(tzinfo=pytz.utc)
-        request = (json.dumps(message.message_in, cls=JSONProtocolElementEncoder)
-                   if message.message_in else '')
-
-        response_ts = datetime.datetime.utcfromtimestamp(message.timestamp_out).replace(tzinfo=pytz.utc)
-        response = (json.dumps(message.message_out, cls=JSONProtocolElementEncoder)
-                    if message.message_out else '')
-
-        Transaction.objects.update_or_create(client=client,
-                                             server=server,
-                                             request_ts=request_ts,
-                                             defaults={
-                                                 'request_type': info['request_type'],
-                                                 'request': request,
-                                                 'request_ll': info['link_local'],
+        server_id = self._get_server_id(message.server_name)
+        client_id = self._get_client_id(info['duid'], info['interface_id'], info['remote_id'])
 
-                                                 'response_type': info['response_type'],
-                                                 'response_ts': response_ts,
-                                                 'response': response,
-                                             })
+        request_ts = datetime.datetime.fromtimestamp(message.timestamp_in, datetime.timezone.utc)
+        request = _dump_message(message.message_in) if message.message_in else ''
+
+        if message.message_out:
+            response_ts = datetime.datetime.fromtimestamp(message.timestamp_out, datetime.timezone.utc)
+            response = _dump_message(message.message_out)
+        else:
+            # No response: don't record a timestamp for one either
+            response_ts = None
+            response = ''
+
+        return Transaction(client_id=client_id,
+                           server_id=server_id,
+                           request_ts=request_ts,
+                           request_type=info['request_type'],
+                           request=request,
+                           request_ll=info['link_local'],
+
+                           response_type=info['response_type'],
+                           response_ts=response_ts,
+                           response=response)
+
+    def prune_transactions(self):
+        """
+        Remove transactions that are too old or that exceed the per client/server limit,
+        for all client/server pairs touched since the last run. Runs at most once every
+        PRUNE_INTERVAL seconds
+        """
+        now = time.monotonic()
+        if not self._dirty_pairs or now - self._last_prune < PRUNE_INTERVAL:
+            return
+
+        self._last_prune = now
+        total_deleted = 0
 
-        # Only keep the last transactions per client/server
-        if app_settings.MAX_TRANSACTIONS or app_settings.MAX_TRANSACTION_AGE:
-            my_transactions = Transaction.objects.filter(client=client, server=server)
-            keep = my_transactions
+        if app_settings.MAX_TRANSACTION_AGE:
+            # One indexed delete for everything that is too old, whoever it belongs to
+            deadline = timezone.now() - app_settings.MAX_TRANSACTION_AGE
+            total_deleted += self._prune_queryset(Transaction.objects.filter(request_ts__lt=deadline))
 
-            if app_settings.MAX_TRANSACTION_AGE:
-                deadline = request_ts - app_settings.MAX_TRANSACTION_AGE
-                keep = keep.filter(request_ts__gte=deadline)
+        if app_settings.MAX_TRANSACTIONS:
+            for client_id, server_id in self._dirty_pairs:
+                my_transactions = Transaction.objects.filter(client_id=client_id, server_id=server_id)
+                keep = my_transactions.order_by('-request_ts')[:app_settings.MAX_TRANSACTIONS]
+                total_deleted += self._prune_queryset(my_transactions.exclude(pk__in=keep))
 
-            if app_settings.MAX_TRANSACTIONS:
-                keep = keep.order_by('-request_ts')[:app_settings.MAX_TRANSACTIONS]
+        self._dirty_pairs = set()
 
-            delete = my_transactions.exclude(pk__in=keep)
-            deleted, per_model = delete.delete()
-            if deleted:
-                logger.debug("Deleted {} old transactions".format(deleted))
+        if total_deleted:
+            logger.debug("Deleted {} old transactions".format(total_deleted))
+
+    @staticmethod
+    def _prune_queryset(doomed) -> int:
+        """
+        Delete a set of transactions without the signal-firing ORM cascade, fixing up the
+        per-client transaction counters that the skipped signals would have maintained
+
+        :param doomed: The queryset with transactions to delete
+        :return: The number of deleted transactions
+        """
+        affected = set(doomed.values_list('client_id', flat=True).distinct())
+        if not affected:
+            return 0
+
+        # Transaction has nothing cascading onto it, so a raw delete safely skips the
+        # SELECT plus per-row signal dispatch that QuerySet.delete() pays for
+        # noinspection PyProtectedMember
+        deleted = doomed._raw_delete(using=doomed.db)
+
+        # Recompute the counters for the clients that lost transactions. The recount runs in
+        # chunks to stay under the bind-parameter limit, and a failure here must not unwind
+        # into the consume loop: the transactions are already deleted, so worst case some
+        # counters stay stale until the next prune touches them.
+        try:
+            counts = dict.fromkeys(affected, 0)
+            affected = list(affected)
+            for start in range(0, len(affected), QUERY_CHUNK_SIZE):
+                chunk = affected[start:start + QUERY_CHUNK_SIZE]
+                counts.update(Transaction.objects.filter(client_id__in=chunk)
+                              .values_list('client_id')
+                              .annotate(transaction_count=Count('id')))
+            for client_id, count in counts.items():
+                Client.objects.filter(pk=client_id).update(num_transactions=count)
+        except Exception as e:
+            logger.error("Failed to update transaction counters after pruning: {}".format(e))
+
+        return deleted
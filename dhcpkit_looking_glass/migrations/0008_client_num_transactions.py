@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models.aggregates import Count
+
+
+def fill_transaction_counts(apps, schema_editor):
+    # Get the model
+    client_model = apps.get_model('dhcpkit_looking_glass', 'Client')
+
+    # Store the current transaction count on each client
+    for client in client_model.objects.annotate(transaction_count=Count('transaction')):
+        if client.transaction_count != client.num_transactions:
+            client.num_transactions = client.transaction_count
+            client.save(update_fields=['num_transactions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dhcpkit_looking_glass', '0007_fix_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='num_transactions',
+            field=models.PositiveIntegerField(db_index=True, default=0, verbose_name='transactions'),
+        ),
+        migrations.RunPython(fill_transaction_counts, migrations.RunPython.noop),
+    ]
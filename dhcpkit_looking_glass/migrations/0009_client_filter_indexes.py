@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dhcpkit_looking_glass', '0008_client_num_transactions'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='client',
+            index_together={('interface_id', 'duid'),
+                            ('remote_id', 'duid'),
+                            ('interface_id', 'remote_id', 'duid')},
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def add_trigram_indexes(apps, schema_editor):
+    # Only PostgreSQL has the pg_trgm extension; other databases keep using plain LIKE scans
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    table = apps.get_model('dhcpkit_looking_glass', 'Transaction')._meta.db_table
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute("CREATE INDEX IF NOT EXISTS transaction_request_trgm "
+                          "ON {} USING gin (request gin_trgm_ops)".format(table))
+    schema_editor.execute("CREATE INDEX IF NOT EXISTS transaction_response_trgm "
+                          "ON {} USING gin (response gin_trgm_ops)".format(table))
+
+
+def remove_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute("DROP INDEX IF EXISTS transaction_request_trgm")
+    schema_editor.execute("DROP INDEX IF EXISTS transaction_response_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dhcpkit_looking_glass', '0009_client_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_trigram_indexes, remove_trigram_indexes),
+    ]
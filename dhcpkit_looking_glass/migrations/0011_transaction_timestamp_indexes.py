@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dhcpkit_looking_glass', '0010_transaction_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='request_ts',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='request timestamp'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='response_ts',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='response timestamp'),
+        ),
+    ]
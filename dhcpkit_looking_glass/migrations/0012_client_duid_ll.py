@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from dhcpkit_looking_glass.utils import mac_from_duid
+
+
+def fill_duid_ll(apps, schema_editor):
+    """
+    Extract the link-layer address from the DUID of each existing client
+
+    :param apps: The registry with historical models
+    :param schema_editor: Unused
+    """
+    client_model = apps.get_model('dhcpkit_looking_glass', 'Client')
+    for pk, duid in client_model.objects.values_list('pk', 'duid').iterator():
+        mac = mac_from_duid(duid)
+        if mac:
+            client_model.objects.filter(pk=pk).update(duid_ll=str(mac))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dhcpkit_looking_glass', '0011_transaction_timestamp_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='duid_ll',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=17,
+                                   verbose_name='MAC from DUID'),
+        ),
+        migrations.RunPython(fill_duid_ll, migrations.RunPython.noop),
+    ]
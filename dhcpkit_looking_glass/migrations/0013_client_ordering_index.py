@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dhcpkit_looking_glass', '0012_client_duid_ll'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='client',
+            index_together=set([('interface_id', 'duid'),
+                                ('remote_id', 'duid'),
+                                ('interface_id', 'remote_id', 'duid'),
+                                ('remote_id', 'interface_id', 'duid')]),
+        ),
+    ]
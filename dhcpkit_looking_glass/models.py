@@ -1,17 +1,15 @@
 """
 Represent the database that the option handler creates
 """
-from collections import OrderedDict
-from ipaddress import IPv6Address
+import socket
 
-import yaml
-from dhcpkit.ipv6.duids import DUID
 from django.db import models
+from django.db.models.expressions import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
-from netaddr.eui import EUI
-from netaddr.strategy.eui48 import mac_unix_expanded
 
-from dhcpkit_looking_glass.utils import json_message_to_html
+from dhcpkit_looking_glass.utils import format_mac, json_message_to_html, oui_org
 
 
 class Server(models.Model):
@@ -37,10 +35,23 @@ class Client(models.Model):
     interface_id = models.CharField(_('Interface-ID'), max_length=256, blank=True)
     remote_id = models.CharField(_('Remote-ID'), max_length=512, blank=True)
 
+    # Filled at insert time (and by the data migration) so list views don't have to parse
+    # the DUID per row
+    duid_ll = models.CharField(_('MAC from DUID'), max_length=17, blank=True, default='', db_index=True)
+
+    # Maintained by the signal handlers below so list views don't need a COUNT() per row
+    num_transactions = models.PositiveIntegerField(_('transactions'), default=0, db_index=True)
+
     class Meta:
         verbose_name = _('client')
         verbose_name_plural = _('clients')
         unique_together = (('duid', 'interface_id', 'remote_id'),)
+        # Covering indexes for the duplicate-DUID filters, which group by these columns,
+        # and for the default ordering below so list views don't sort the whole table
+        index_together = (('interface_id', 'duid'),
+                          ('remote_id', 'duid'),
+                          ('interface_id', 'remote_id', 'duid'),
+                          ('remote_id', 'interface_id', 'duid'))
         ordering = ('remote_id', 'interface_id', 'duid')
 
     def __str__(self):
@@ -53,44 +64,21 @@ class Client(models.Model):
         else:
             return self.duid
 
-    def duid_ll(self):
-        """
-        Get the link-layer address stored in the DUID, if any
-
-        :return: Link-layer address or None
-        """
-
-        # noinspection PyBroadException
-        try:
-            duid_str = self.duid
-            if duid_str.startswith('0x'):
-                duid_str = duid_str[2:]
-            duid_bytes = bytes.fromhex(duid_str)
-            length, duid = DUID.parse(duid_bytes, length=len(duid_bytes))
-
-            if getattr(duid, 'hardware_type') == 1 and hasattr(duid, 'link_layer_address'):
-                return EUI(int.from_bytes(duid.link_layer_address, byteorder='big'), dialect=mac_unix_expanded)
-        except:
-            pass
-
-        return None
-
-    duid_ll.short_description = _('MAC from DUID')
-    duid_ll = property(duid_ll)
-
     def duid_ll_org(self):
         """
         Get the vendor from the link-layer address in the DUID, if available
 
         :return: Vendor name or None
         """
-        duid_ll = self.duid_ll
-        if duid_ll:
-            reg = duid_ll.oui.registration()
-            if reg:
-                return reg['org']
-
-        return None
+        try:
+            return self._duid_ll_org_cache
+        except AttributeError:
+            if self.duid_ll:
+                org = oui_org(int(self.duid_ll.replace(':', '')[:6], 16))
+            else:
+                org = None
+            self._duid_ll_org_cache = org
+            return org
 
     duid_ll_org.short_description = _('MAC vendor')
     duid_ll_org = property(duid_ll_org)
@@ -106,11 +94,11 @@ class Transaction(models.Model):
     request_type = models.CharField(_('request type'), max_length=50, blank=True, null=True)
     request = models.TextField(_('request'), blank=True, null=True)
     request_ll = models.GenericIPAddressField(_('Link-local address'), protocol='ipv6', blank=True, null=True)
-    request_ts = models.DateTimeField(_('request timestamp'), blank=True, null=True)
+    request_ts = models.DateTimeField(_('request timestamp'), blank=True, null=True, db_index=True)
 
     response_type = models.CharField(_('response type'), max_length=50, blank=True, null=True)
     response = models.TextField(_('response'), blank=True, null=True)
-    response_ts = models.DateTimeField(_('response timestamp'), blank=True, null=True)
+    response_ts = models.DateTimeField(_('response timestamp'), blank=True, null=True, db_index=True)
 
     class Meta:
         verbose_name = _('transaction')
@@ -123,30 +111,41 @@ class Transaction(models.Model):
                                                                          server=self.server,
                                                                          ts=self.request_ts)
 
-    def request_ll_mac(self):
+    def _request_ll_mac_int(self):
         """
-        Try to get the MAC address based on the link-local address, if possible
+        Try to get the MAC address embedded in the link-local address, as an integer
 
-        :return: MAC address or None
+        :return: MAC address as an integer, or None
         """
-
-        if not self.request_ll:
-            return None
-
-        # noinspection PyBroadException
         try:
-            addr = IPv6Address(self.request_ll)
-            int_id = bytearray(addr.packed[8:])
-            if int_id[3:5] == b'\xff\xfe':
-                # Extract bytes and flip the right bit
-                mac_bytes = int_id[0:3] + int_id[5:8]
-                mac_bytes[0] ^= 2
-
-                return EUI(int.from_bytes(mac_bytes, byteorder='big'), dialect=mac_unix_expanded)
-        except:
+            return self._request_ll_mac_int_cache
+        except AttributeError:
             pass
 
-        return None
+        mac_int = None
+        if self.request_ll:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, self.request_ll)
+                interface_id = int.from_bytes(packed[8:], byteorder='big')
+                if (interface_id >> 24) & 0xffff == 0xfffe:
+                    # Splice out the ff:fe padding and flip the universal/local bit, all on
+                    # the 64-bit integer so no intermediate byte strings are allocated
+                    mac_int = ((interface_id >> 16) & 0xffffff000000) | (interface_id & 0xffffff)
+                    mac_int ^= 0x020000000000
+            except OSError:
+                pass
+
+        self._request_ll_mac_int_cache = mac_int
+        return mac_int
+
+    def request_ll_mac(self):
+        """
+        Try to get the MAC address based on the link-local address, if possible
+
+        :return: MAC address as a string, or None
+        """
+        mac_int = self._request_ll_mac_int()
+        return format_mac(mac_int) if mac_int is not None else None
 
     request_ll_mac.short_description = _('Embedded MAC')
     request_ll_mac = property(request_ll_mac)
@@ -157,13 +156,13 @@ class Transaction(models.Model):
 
         :return: Vendor name or None
         """
-        request_ll_mac = self.request_ll_mac
-        if request_ll_mac:
-            reg = request_ll_mac.oui.registration()
-            if reg:
-                return reg['org']
-
-        return None
+        try:
+            return self._request_ll_mac_org_cache
+        except AttributeError:
+            mac_int = self._request_ll_mac_int()
+            org = oui_org(mac_int >> 24) if mac_int is not None else None
+            self._request_ll_mac_org_cache = org
+            return org
 
     request_ll_mac_org.short_description = 'MAC vendor'
     request_ll_mac_org = property(request_ll_mac_org)
@@ -174,7 +173,11 @@ class Transaction(models.Model):
 
         :return: HTML or None
         """
-        return json_message_to_html(self.request)
+        try:
+            return self._request_html_cache
+        except AttributeError:
+            self._request_html_cache = json_message_to_html(self.request)
+            return self._request_html_cache
 
     request_html.short_description = _('request')
     request_html.allow_tags = True
@@ -186,7 +189,11 @@ class Transaction(models.Model):
 
         :return: HTML or None
         """
-        return json_message_to_html(self.response)
+        try:
+            return self._response_html_cache
+        except AttributeError:
+            self._response_html_cache = json_message_to_html(self.response)
+            return self._response_html_cache
 
     response_html.short_description = _('response')
     response_html.allow_tags = True
@@ -238,6 +245,28 @@ class Transaction(models.Model):
     client_remote_id = property(client_remote_id)
 
 
-# Proper representation of OrderedDict
-yaml.add_representer(OrderedDict,
-                     lambda self, data: self.represent_mapping('tag:yaml.org,2002:map', data.items()))
+# noinspection PyUnusedLocal
+@receiver(post_save, sender=Transaction, dispatch_uid='dhcpkit_lg_count_transactions')
+def increment_transaction_count(sender, instance: Transaction, created: bool, **kwargs):
+    """
+    Keep the denormalized transaction counter on the client up to date
+
+    :param sender: The Transaction model
+    :param instance: The saved transaction
+    :param created: Whether this save created the transaction
+    """
+    if created:
+        Client.objects.filter(pk=instance.client_id).update(num_transactions=F('num_transactions') + 1)
+
+
+# noinspection PyUnusedLocal
+@receiver(post_delete, sender=Transaction, dispatch_uid='dhcpkit_lg_uncount_transactions')
+def decrement_transaction_count(sender, instance: Transaction, **kwargs):
+    """
+    Keep the denormalized transaction counter on the client up to date
+
+    :param sender: The Transaction model
+    :param instance: The deleted transaction
+    """
+    Client.objects.filter(pk=instance.client_id).update(num_transactions=F('num_transactions') - 1)
+
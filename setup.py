@@ -46,14 +46,15 @@ setup(
         'Operating System :: POSIX',
         'Operating System :: Unix',
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Topic :: Internet',
         'Topic :: System :: Networking',
         'Topic :: System :: Systems Administration',
     ],
 
     packages=find_packages(exclude=['tests', 'tests.*']),
+    python_requires='>=3.6',
     include_package_data=True,
     entry_points={
     },
@@ -62,9 +63,15 @@ setup(
         'django >= 1.8',
         'dhcpkit_kafka >= 0.9.0',
         'netaddr',
-        'pyyaml',
-        'pytz',
+        'pyyaml >= 5.1',
     ],
+    extras_require={
+        # Optional accelerators for busy deployments: faster JSON serialisation and
+        # support for Kafka topics using snappy/lz4 compressed batches
+        'fast-json': ['orjson'],
+        'snappy': ['python-snappy'],
+        'lz4': ['lz4'],
+    },
 
     test_suite='tests',
 